@@ -1,7 +1,64 @@
-import pandas as pd
 import socket
+import itertools
 import json
+import selectors
 import threading
+from dataclasses import dataclass
+from datetime import datetime
+
+try:
+    import orjson
+
+    def dump_message(msg):
+        """Serialize a message to a newline-terminated JSON line."""
+        payload = orjson.dumps(msg)
+        if b'null' in payload:
+            # orjson writes NaN/Infinity as null; json.dumps keeps those tokens (and writes None the same)
+            return (json.dumps(msg) + '\n').encode('utf-8')
+        return payload + b'\n'
+
+    def load_message(line):
+        """Parse a JSON line, accepting the NaN/Infinity tokens orjson rejects."""
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            return json.loads(line)
+except ImportError:
+    def dump_message(msg):
+        """Serialize a message to a newline-terminated JSON line."""
+        return (json.dumps(msg) + '\n').encode('utf-8')
+
+    load_message = json.loads
+
+RECV_SIZE = 65536
+SOCKET_BUFFER_SIZE = 1 << 20
+
+
+@dataclass(slots=True)
+class Bar:
+    time: datetime
+    open_: float
+    high: float
+    low: float
+    close: float
+
+
+@dataclass(slots=True)
+class Order:
+    orderId: int
+
+
+@dataclass(slots=True)
+class OrderStatus:
+    status: str
+    avgFillPrice: float
+
+
+@dataclass(slots=True)
+class Trade:
+    order: Order
+    orderStatus: OrderStatus
+
 
 class TWSClient:
     def __init__(self, host='127.0.0.1', port=7498):
@@ -12,19 +69,33 @@ class TWSClient:
         self.running = False
         self.bar_callback = None
         self.order_status_callback = None
+        self.next_order_id = itertools.count(1)
         self.lock = threading.Lock()
-        self.stop_event = threading.Event()
-        self.listen_thread = None
+        self.selector = None
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        self.run_active = False
+        self.buffer = bytearray()
+        self.handlers = {
+            'barUpdate': self._handle_bar_update,
+            'orderStatus': self._handle_order_status,
+            'endOfData': self._handle_end_of_data,
+        }
 
     def connect(self):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
             self.socket.connect((self.host, self.port))
+            # disconnect() writes to the wakeup pair so run() can block in select() without a timeout
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket, selectors.EVENT_READ, self._drain_socket)
+            self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+            self.buffer = bytearray()
             self.connected = True
             self.running = True
-            self.stop_event.clear()
-            self.listen_thread = threading.Thread(target=self.listen, daemon=True)
-            self.listen_thread.start()
             print(f"Connected to {self.host}:{self.port}")
         except Exception as e:
             print(f"Connection failed: {e}")
@@ -32,19 +103,29 @@ class TWSClient:
             self.running = False
 
     def disconnect(self):
+        # Held until the sockets are no longer used; run() takes it before closing them
         with self.lock:
-            if self.connected:
-                try:
-                    self.socket.send((json.dumps({'type': 'disconnect'}) + '\n').encode('utf-8'))
-                except Exception as e:
-                    print(f"Disconnect send error: {e}")
-                self.socket.close()
-                self.connected = False
-                self.running = False
-                self.stop_event.set()
-                print("Disconnected from emulator")
-            else:
+            if not self.connected:
                 print("Already disconnected")
+                return
+            self.connected = False
+            self.running = False
+            try:
+                self.socket.sendall(dump_message({'type': 'disconnect'}))
+            except Exception as e:
+                print(f"Disconnect send error: {e}")
+            if self.run_active:
+                # run() closes everything once it wakes; closing here could drop the wakeup event
+                self.wakeup_writer.send(b'\0')
+            else:
+                self._close_sockets()
+        print("Disconnected from emulator")
+
+    def _close_sockets(self):
+        self.selector.close()
+        self.socket.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
 
     def req_real_time_bars(self, contract, bar_size, callback):
         self.bar_callback = callback
@@ -52,77 +133,77 @@ class TWSClient:
         print(f"Requested real-time bars with size {bar_size}")
 
     def place_order(self, contract, order):
+        order_id = next(self.next_order_id)
         msg = {
             'type': 'placeOrder',
+            'orderId': order_id,
             'order': {'action': order.action, 'quantity': order.totalQuantity}
         }
-        order_id = id(order)
         self.send(msg)
-        trade = type('Trade', (), {
-            'order': type('Order', (), {'orderId': order_id}),
-            'orderStatus': type('OrderStatus', (), {
-                'status': 'Filled',
-                'avgFillPrice': 0.0  # Placeholder
-            })
-        })
-        if self.order_status_callback:
-            self.order_status_callback(trade)
+        # The emulator answers with an orderStatus carrying this id, which reaches order_status_callback
         return order_id
 
     def send(self, msg):
-        with self.lock:
-            if self.connected:
-                try:
-                    self.socket.send((json.dumps(msg) + '\n').encode('utf-8'))
-                    # print(f"Sent message: {msg}")
-                except Exception as e:
-                    print(f"Send error: {e}")
-                    self.disconnect()
-
-    def listen(self):
-        buffer = ""
-        while self.running:  # Use running to align with disconnect logic
+        if self.connected:
             try:
-                data = self.socket.recv(4096).decode('utf-8')
-                if not data:
-                    print("Socket closed by emulator")
-                    self.disconnect()
-                    break
-                buffer += data
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line.strip():
-                        msg = json.loads(line)
-                        # print(f"Received message: {msg}")
-                        if msg['type'] == 'barUpdate' and self.bar_callback:
-                            bar = type('Bar', (), {
-                                'time': pd.to_datetime(msg['time']),
-                                'open_': msg['open'],
-                                'high': msg['high'],
-                                'low': msg['low'],
-                                'close': msg['close']
-                            })
-                            self.bar_callback(bar, True)
-                        elif msg['type'] == 'orderStatus' and self.order_status_callback:
-                            trade = type('Trade', (), {
-                                'order': type('Order', (), {'orderId': msg['orderId']}),
-                                'orderStatus': type('OrderStatus', (), {
-                                    'status': msg['status'],
-                                    'avgFillPrice': msg['avgFillPrice']
-                                })
-                            })
-                            self.order_status_callback(trade)
-                        elif msg['type'] == 'endOfData':
-                            print("Received endOfData signal")
-                            self.disconnect()
-                            break  # Exit immediately after disconnect
-            except json.JSONDecodeError as e:
-                print(f"Client JSON error: {e} - Buffer: {buffer!r}")
+                self.socket.sendall(dump_message(msg))
+                # print(f"Sent message: {msg}")
             except Exception as e:
-                print(f"Client listen error: {e}")
+                print(f"Send error: {e}")
+                self.disconnect()
+
+    def _drain_socket(self):
+        try:
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                print("Socket closed by emulator")
                 self.disconnect()
-                break
-        print("Listen thread exiting")
+                return
+            self.buffer.extend(data)
+            idx = self.buffer.find(b'\n')
+            while idx != -1:
+                line = bytes(self.buffer[:idx])
+                del self.buffer[:idx + 1]  # bytearray drops a prefix in place without copying the rest
+                idx = self.buffer.find(b'\n')
+                if line.strip():
+                    try:
+                        msg = load_message(line)
+                    except json.JSONDecodeError as e:
+                        # Skip just this line so the rest of the buffer still gets processed
+                        print(f"Client JSON error: {e} - Line: {line!r}")
+                        continue
+                    # print(f"Received message: {msg}")
+                    handler = self.handlers.get(msg['type'])
+                    if handler:
+                        handler(msg)
+                        if not self.connected:
+                            return  # Stop processing immediately after disconnect
+        except Exception as e:
+            print(f"Client listen error: {e}")
+            self.disconnect()
+
+    def _handle_bar_update(self, msg):
+        if self.bar_callback:
+            bar = Bar(
+                time=datetime.fromisoformat(msg['time']),
+                open_=msg['open'],
+                high=msg['high'],
+                low=msg['low'],
+                close=msg['close']
+            )
+            self.bar_callback(bar, True)
+
+    def _handle_order_status(self, msg):
+        if self.order_status_callback:
+            trade = Trade(
+                order=Order(msg['orderId']),
+                orderStatus=OrderStatus(msg['status'], msg['avgFillPrice'])
+            )
+            self.order_status_callback(trade)
+
+    def _handle_end_of_data(self, msg):
+        print("Received endOfData signal")
+        self.disconnect()
 
     def set_order_status_callback(self, callback):
         self.order_status_callback = callback
@@ -133,16 +214,20 @@ class TWSClient:
             print("Cannot run: Not connected")
             return
         print("Client running...")
-        while self.running:
-            self.stop_event.wait(timeout=1.0)  # Wait until stop_event is set
-            if not self.running:
-                break
-        if self.listen_thread and self.listen_thread.is_alive():
-            self.listen_thread.join(timeout=2.0)
-            if self.listen_thread.is_alive():
-                print("Warning: Listen thread did not exit cleanly")
-        print("Client stopped")
-        # Only disconnect if not already done
         with self.lock:
+            self.run_active = True
+        try:
+            while self.running:
+                for key, _ in self.selector.select():
+                    if key.data:
+                        key.data()
+        finally:
+            with self.lock:
+                self.run_active = False
+            print("Client stopped")
+            # Only disconnect if not already done
             if self.connected:
-                self.disconnect()
\ No newline at end of file
+                self.disconnect()
+            else:
+                with self.lock:
+                    self._close_sockets()
\ No newline at end of file
@@ -1,122 +1,265 @@
+import asyncio
 import socket
-import threading
+import numpy as np
 import pandas as pd
-import time
 import json
 import argparse
+import multiprocessing
 from datetime import datetime
 import pytz
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson
+
+    def dump_message(msg):
+        """Serialize a message to a newline-terminated JSON line."""
+        payload = orjson.dumps(msg)
+        if b'null' in payload:
+            # orjson writes NaN/Infinity as null; json.dumps keeps those tokens (and writes None the same)
+            return (json.dumps(msg) + '\n').encode('utf-8')
+        return payload + b'\n'
+
+    def load_message(line):
+        """Parse a JSON line, accepting the NaN/Infinity tokens orjson rejects."""
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            return json.loads(line)
+except ImportError:
+    def dump_message(msg):
+        """Serialize a message to a newline-terminated JSON line."""
+        return (json.dumps(msg) + '\n').encode('utf-8')
+
+    load_message = json.loads
+
 # Timezone for consistency (matches your BACKTEST_TZ)
 TZ = pytz.timezone("America/New_York")
+# Kernel send/receive buffer size for client connections
+SOCKET_BUFFER_SIZE = 1 << 20
+# Bars written to a client per socket write in stream_bars
+BARS_PER_CHUNK = 64
+# Simulated real-time spacing between streamed bars, in seconds
+BAR_INTERVAL = 0.01
+
+def isoformat_dates(dates):
+    """Vectorized Timestamp.isoformat() for a tz-aware datetime Series, as a NumPy array."""
+    local = dates.dt.tz_localize(None).to_numpy('datetime64[ns]')
+    utc = dates.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy('datetime64[ns]')
+    text = np.datetime_as_string(local, unit='s')
+    # isoformat only writes a fraction when there is one: .ffffff, or .fffffffff with nanoseconds
+    nanos = local.view(np.int64) % 1_000_000_000
+    if nanos.any():
+        text = np.where(nanos == 0, text, np.where(
+            nanos % 1000 == 0, np.datetime_as_string(local, unit='us'), np.datetime_as_string(local, unit='ns')))
+    # Few distinct UTC offsets per file, so format each once and index into them
+    offset_minutes, inverse = np.unique((local - utc).astype('timedelta64[m]').astype(np.int64), return_inverse=True)
+    offsets = np.array([f"{'-' if m < 0 else '+'}{abs(m) // 60:02d}:{abs(m) % 60:02d}" for m in offset_minutes], dtype=str)
+    return np.char.add(text, offsets[inverse.reshape(-1)])
 
 class TWSEmulator:
-    def __init__(self, host='127.0.0.1', port=7498, data_file=None):
+    def __init__(self, host='127.0.0.1', port=7498, data_file=None, reuse_port=False):
         self.host = host
         self.port = port
         self.data_file = data_file
+        self.reuse_port = reuse_port
         self.data_df = None
-        self.clients = []
+        self.bar_blob = b''
+        self.bar_offsets = None
+        self.clients = set()  # Only touched from the event loop thread, so no lock
         self.orders = {}
         self.order_id = 0
         self.running = False
-        self.server_socket = None
+        self.server = None
+        self.stream_tasks = set()
+        self.handlers = {
+            'reqRealTimeBars': self.handle_req_real_time_bars,
+            'placeOrder': self.handle_order,
+            'disconnect': self.handle_disconnect,
+        }
 
     def load_data(self):
-        """Load data from .pkl file and prepare it for streaming."""
+        """Load data from .pkl or .parquet file and prepare it for streaming."""
         if not self.data_file:
             raise ValueError("Data file path is required")
-        self.data_df = pd.read_pickle(self.data_file)
-        self.data_df['date'] = pd.to_datetime(self.data_df['date'])
+        if str(self.data_file).endswith('.parquet'):
+            self.data_df = pd.read_parquet(self.data_file, engine='pyarrow')
+        else:
+            self.data_df = pd.read_pickle(self.data_file)
+        # Parquet (and most pickles) already store typed timestamps; only parse strings
+        if not pd.api.types.is_datetime64_any_dtype(self.data_df['date']):
+            self.data_df['date'] = pd.to_datetime(self.data_df['date'])
         # Localize to TZ if naive
         if self.data_df['date'].dt.tz is None:
             self.data_df['date'] = self.data_df['date'].dt.tz_localize(TZ)
+        self.data_df['date_iso'] = isoformat_dates(self.data_df['date'])
         print(f"Loaded {len(self.data_df)} bars from {self.data_file}")
+        self.serialize_bars()
+
+    def serialize_bars(self):
+        """Serialize the 5-second bars once into a blob shared by every client.
+
+        bar_offsets[i]:bar_offsets[i + 1] is the byte range of bar i's JSON line.
+        """
+        df = self.aggregate_to_seconds('5s')
+        times = df['date_iso'].to_numpy()
+        # json.dumps keeps stdlib float formatting, including NaN/Infinity for non-finite prices
+        opens, highs, lows, closes = ([json.dumps(value) for value in df[col].tolist()] for col in ('open', 'high', 'low', 'close'))
+        parts = [
+            f'{{"type": "barUpdate", "time": "{time}", "open": {open_}, "high": {high}, "low": {low}, "close": {close}}}\n'.encode('utf-8')
+            for time, open_, high, low, close in zip(times, opens, highs, lows, closes)
+        ]
+        self.bar_blob = b''.join(parts)
+        self.bar_offsets = np.cumsum([0] + [len(part) for part in parts], dtype=np.int64)
 
     def aggregate_to_seconds(self, target_freq='5s'):
         """Aggregate data to 5-second bars if not already in that frequency."""
-        time_diffs = self.data_df['date'].diff().dt.total_seconds().dropna()
-        freq_mode = time_diffs.mode()[0] if not time_diffs.empty else 60
+        dates = self.data_df['date'].values
+        freq_mode = (dates[1] - dates[0]) / np.timedelta64(1, 's') if len(dates) > 1 else 60
+        if not (abs(freq_mode - 5) < 2 or abs(freq_mode - 60) < 10):
+            # First gap is irregular (e.g. a missing bar); fall back to the most common spacing
+            time_diffs = self.data_df['date'].diff().dt.total_seconds().dropna()
+            freq_mode = time_diffs.mode()[0]
         if abs(freq_mode - 5) < 2:  # Already ~5 seconds
             return self.data_df
         elif abs(freq_mode - 60) < 10:  # ~1 minute, resample to 5 seconds
-            result_df = self.data_df.resample(target_freq, on='date').agg({
-                'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last'
-            }).dropna().reset_index()
+            result_df = self.resample_bars(target_freq)
             print(f"Resampled from ~{freq_mode}s to 5s: {len(result_df)} bars")
             return result_df
         else:
             raise ValueError(f"Unsupported frequency: {freq_mode} seconds")
 
-    def start_server(self):
-        """Start the TCP server to accept client connections."""
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+    def resample_bars(self, target_freq):
+        """Reduce data_df to OHLC bars of target_freq in one pass over the column arrays.
+
+        Matches resample(...).agg(first/max/min/last).dropna(): each column skips its own
+        NaNs within a bin, and bins left with any NaN field are dropped.
+        """
+        df = self.data_df
+        if not df['date'].is_monotonic_increasing:
+            df = df.sort_values('date')
+        if df.empty:
+            return df[['date', 'date_iso', 'open', 'high', 'low', 'close']].reset_index(drop=True)
+        # Bin ids from UTC nanoseconds (bins are aligned in UTC, so DST shifts can't make labels ambiguous)
+        bin_ns = pd.Timedelta(target_freq).value
+        bins = df['date'].values.astype('datetime64[ns]').view(np.int64) // bin_ns
+        new_bin = np.r_[True, bins[1:] != bins[:-1]]
+        starts = np.flatnonzero(new_bin)  # Row index where each bin starts
+        bin_of_row = np.cumsum(new_bin) - 1
+        labels = pd.to_datetime(bins[starts] * bin_ns, utc=True).tz_convert(df['date'].dt.tz)
+
+        def first_last(values, last):
+            """First (or last) non-NaN value of each bin; NaN for bins without one."""
+            if values.dtype.kind != 'f':
+                return values[np.r_[starts[1:], len(values)] - 1] if last else values[starts]
+            rows = np.flatnonzero(~np.isnan(values))
+            row_bins = bin_of_row[rows]
+            edge = np.r_[True, row_bins[1:] != row_bins[:-1]]
+            if last:
+                edge = np.r_[edge[1:], True]
+            result = np.full(len(starts), np.nan)
+            result[row_bins[edge]] = values[rows[edge]]
+            return result
+
+        # fmax/fmin ignore NaN unless the whole bin is NaN
+        result_df = pd.DataFrame({
+            'date': labels,
+            'open': first_last(df['open'].to_numpy(), last=False),
+            'high': np.fmax.reduceat(df['high'].to_numpy(), starts),
+            'low': np.fmin.reduceat(df['low'].to_numpy(), starts),
+            'close': first_last(df['close'].to_numpy(), last=True),
+        }).dropna().reset_index(drop=True)
+        result_df.insert(1, 'date_iso', isoformat_dates(result_df['date']))
+        return result_df
+
+    async def start_server(self):
+        """Start the TCP server and serve clients on the event loop."""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Let several emulator processes bind the port; the kernel spreads connections across them
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Set before listen() so accepted sockets inherit the larger buffers
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        server_socket.bind((self.host, self.port))
+        self.server = await asyncio.start_server(self.handle_client, sock=server_socket)
         print(f"TWS Emulator listening on {self.host}:{self.port}")
         self.running = True
-        threading.Thread(target=self.accept_clients, daemon=True).start()
-
-    def accept_clients(self):
-        """Accept incoming client connections."""
-        while self.running:
-            try:
-                client_socket, addr = self.server_socket.accept()
-                print(f"Client connected from {addr}")
-                self.clients.append(client_socket)
-                threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
-            except Exception as e:
-                if self.running:
-                    print(f"Error accepting client: {e}")
-
-    def handle_client(self, client_socket):
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.stop()
+
+    async def handle_client(self, reader, writer):
         """Handle messages from a connected client."""
-        while self.running:
-            try:
-                data = client_socket.recv(4096).decode('utf-8')
-                if not data:
-                    self.clients.remove(client_socket)
-                    client_socket.close()
+        print(f"Client connected from {writer.get_extra_info('peername')}")
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.clients.add(writer)
+        try:
+            while self.running:
+                line = await reader.readline()
+                if not line:
                     break
-                self.process_message(client_socket, data)
-            except Exception as e:
-                print(f"Error handling client: {e}")
-                break
+                self.process_message(writer, line)
+        except Exception as e:
+            print(f"Error handling client: {e}")
+        finally:
+            self.clients.discard(writer)
+            writer.close()
 
-    def process_message(self, client_socket, message):
+    def process_message(self, writer, message):
         """Process incoming messages (e.g., bar requests, orders)."""
         try:
-            msg = json.loads(message)
-            msg_type = msg.get('type')
-
-            if msg_type == 'reqRealTimeBars':
-                # Start streaming bars
-                threading.Thread(target=self.stream_bars, args=(client_socket,), daemon=True).start()
-            elif msg_type == 'placeOrder':
-                self.handle_order(client_socket, msg)
-            elif msg_type == 'disconnect':
-                self.clients.remove(client_socket)
-                client_socket.close()
+            msg = load_message(message)
+            handler = self.handlers.get(msg.get('type'))
+            if handler:
+                handler(writer, msg)
         except json.JSONDecodeError:
             print(f"Invalid message: {message}")
 
-    def stream_bars(self, client_socket):
-        df = self.aggregate_to_seconds('5s')
-        for idx, row in df.iterrows():
-            if not self.running:
+    def handle_req_real_time_bars(self, writer, msg):
+        """Start streaming bars to the client."""
+        task = asyncio.create_task(self.stream_bars(writer))
+        self.stream_tasks.add(task)
+        task.add_done_callback(self.stream_tasks.discard)
+
+    def handle_disconnect(self, writer, msg):
+        """Close the client connection on request."""
+        self.clients.discard(writer)
+        writer.close()
+
+    async def stream_bars(self, writer):
+        offsets = self.bar_offsets
+        num_bars = len(offsets) - 1
+        blob = memoryview(self.bar_blob)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()  # Monotonic; pacing targets absolute deadlines so sleep jitter doesn't accumulate
+        for start in range(0, num_bars, BARS_PER_CHUNK):
+            if not self.running or writer.is_closing():
                 break
-            bar = {'type': 'barUpdate', 'time': row['date'].isoformat(), 'open': row['open'], 'high': row['high'], 'low': row['low'], 'close': row['close']}
-            print(f"Streaming bar: {bar['time']}")
-            self.send_message(client_socket, bar)
-            time.sleep(0.01)  # Simulate real-time
+            end = min(start + BARS_PER_CHUNK, num_bars)
+            print(f"Streaming bars {start + 1}-{end} of {num_bars}")
+            # Plain writes, not loop.sendfile: asyncio's sendfile pauses reading and rejects
+            # writer.write while a chunk is in flight, which holds back order replies
+            writer.write(blob[offsets[start]:offsets[end]])
+            await writer.drain()
+            deadline += BAR_INTERVAL * (end - start)
+            await asyncio.sleep(max(0, deadline - loop.time()))  # sleep(0) still yields when behind schedule
         # Send end-of-data message
-        self.send_message(client_socket, {'type': 'endOfData'})
+        self.send_message(writer, {'type': 'endOfData'})
         print("Finished streaming bars")
 
-    def handle_order(self, client_socket, msg):
+    def handle_order(self, writer, msg):
         """Simulate order placement and fill."""
         self.order_id += 1
+        # Echo the client's order id when it sent one so orders[...] matches the reported orderId
+        order_id = msg.get('orderId', self.order_id)
         order = msg.get('order')
         action = order.get('action')  # 'BUY' or 'SELL'
         quantity = order.get('quantity')
@@ -128,25 +271,25 @@ class TWSEmulator:
         # Send order status update
         status = {
             'type': 'orderStatus',
-            'orderId': self.order_id,
+            'orderId': order_id,
             'status': 'Filled',
             'avgFillPrice': float(fill_price)  # Ensure JSON-serializable
         }
-        self.orders[self.order_id] = {'action': action, 'quantity': quantity, 'fill_price': fill_price}
-        self.send_message(client_socket, status)
+        self.orders[order_id] = {'action': action, 'quantity': quantity, 'fill_price': fill_price}
+        self.send_message(writer, status)
 
-    def send_message(self, client_socket, msg):
+    def send_message(self, writer, msg):
         """Send a JSON message to the client."""
         try:
-            client_socket.send((json.dumps(msg) + '\n').encode('utf-8'))
+            writer.write(dump_message(msg))
         except Exception as e:
             print(f"Error sending message: {e}")
 
     def stop(self):
         """Stop the emulator."""
         self.running = False
-        if self.server_socket:
-            self.server_socket.close()
+        if self.server:
+            self.server.close()
         for client in self.clients:
             client.close()
         print("TWS Emulator stopped")
@@ -154,20 +297,39 @@ class TWSEmulator:
     def run(self):
         """Main run loop."""
         self.load_data()
-        self.start_server()
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
         try:
-            while True:
-                time.sleep(1)  # Keep main thread alive
+            asyncio.run(self.start_server())
         except KeyboardInterrupt:
-            self.stop()
+            pass
+
+def run_worker(data_file):
+    """Run one emulator process sharing the listening port with its siblings."""
+    TWSEmulator(data_file=data_file, reuse_port=True).run()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="TWS API Emulator")
-    parser.add_argument('--data-file', type=str, required=True, help="Path to .pkl data file")
+    parser.add_argument('--data-file', type=str, required=True, help="Path to .pkl or .parquet data file")
+    parser.add_argument('--workers', type=int, default=1, help="Number of emulator processes accepting on the port (SO_REUSEPORT)")
     args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error("--workers > 1 needs SO_REUSEPORT, which this platform does not support")
 
-    emulator = TWSEmulator(data_file=args.data_file)
-    emulator.run()
+    if args.workers > 1:
+        workers = [multiprocessing.Process(target=run_worker, args=(args.data_file,)) for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            # Workers share the terminal's process group and shut down on the same Ctrl+C
+            for worker in workers:
+                worker.join()
+    else:
+        emulator = TWSEmulator(data_file=args.data_file)
+        emulator.run()
 
 """ 
 & C:/Users/mk/miniforge3/envs/torch_env/python.exe c:/Users/mk/Downloads/dev/ib_volatile/tws_emulator.py --data-file "../data/ohlcv_1min_1D_nvda.pkl"